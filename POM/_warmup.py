@@ -0,0 +1,8 @@
+'''
+Compile the Numba kernels used by POM and populate their on-disk
+cache, so later imports don't pay the compilation cost. Run it once
+after installing with the 'jit' extra:
+
+    python -m POM._warmup
+'''
+from . import pom  # noqa F401
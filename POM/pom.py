@@ -1,62 +1,117 @@
+from collections import OrderedDict
+
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional; Voxels falls back to NumPy.
+    njit, prange = None, range
+
+# Only -1, 0 and 1 appear in A, so it's stored compactly as int8 and
+# promoted to float when multiplied by an actuation amount.
 A = np.array([
-    [[0., 0., 0., 0., 0., 0.],
-     [0., 0., 1., 0., 0., -1],
-     [0., -1, 0., 0., 1., 0.]],
-    [[0., 0., -1, 0., 0., 1.],
-     [0., 0., 0., 0., 0., 0.],
-     [1., 0., 0., -1, 0., 0.]],
-    [[0., 1., 0., 0., -1, 0.],
-     [-1, 0., 0., 1., 0., 0.],
-     [0., 0., 0., 0., 0., 0.]]])
+    [[0, 0, 0, 0, 0, 0],
+     [0, 0, 1, 0, 0, -1],
+     [0, -1, 0, 0, 1, 0]],
+    [[0, 0, -1, 0, 0, 1],
+     [0, 0, 0, 0, 0, 0],
+     [1, 0, 0, -1, 0, 0]],
+    [[0, 1, 0, 0, -1, 0],
+     [-1, 0, 0, 1, 0, 0],
+     [0, 0, 0, 0, 0, 0]]], dtype=np.int8)
+
+# The same entries laid out so that A_ROWS[pom, nid] is the contiguous
+# row A[pom, :, nid] along which a node moves in a plane of motion.
+A_ROWS = np.ascontiguousarray(np.transpose(A, (0, 2, 1)))
+
+# Valid nodes have exactly one even coordinate, which determines the
+# node ID. Index by the parity bits (x&1)<<2 | (y&1)<<1 | (z&1); every
+# other pattern is invalid and maps to None.
+_PARITY_TO_NID = (None, None, None, 0, None, 1, 2, None)
+
+# Node IDs 3-5 are the back faces of 0-2 and move with the opposite
+# sign, so their sign bit is XORed into the checkerboard parity. The
+# tuple copy keeps scalar arithmetic in plain Python ints.
+_NID_PAR = np.array([0, 0, 0, 1, 1, 1], dtype=np.int8)
+_NID_PAR_BITS = tuple(int(p) for p in _NID_PAR)
+
+# A servo's plane of motion can't be the direction it moves in or the
+# axis of the voxel boundary it sits on, so it's the remaining axis,
+# 3 - direction - nid % 3. _C_ROT[direction][nid % 3] holds the
+# matching sign correction from A, and _OFFSET the offset from a
+# servo's node to its other node.
+_C_ROT = tuple(tuple(int(A[3 - d - n, d, n]) if d != n else 0
+                     for n in range(3)) for d in range(3))
+_OFFSET = ((2, 0, 0), (0, 2, 0), (0, 0, 2))
+
+# Shared result for nodes a servo doesn't move. It's read-only so that
+# nobody can accidentally modify it in place.
+_ZERO3 = np.zeros(3)
+_ZERO3.flags.writeable = False
 
 
 class Node:
+    __slots__ = ('pos', 'nid')
+
     def __init__(self, x, y, z, nid=None):
-        self.pos = np.array([x, y, z])
-        assert (self.pos % 2).sum() == 2
+        # Plain ints are much cheaper than a tiny array for the few
+        # scalar comparisons a node is ever involved in.
+        self.pos = (int(x), int(y), int(z))
+        assert self.pos == (x, y, z)
+
+        x, y, z = self.pos
+        self.nid = _PARITY_TO_NID[(x & 1) << 2 | (y & 1) << 1 | (z & 1)]
+        assert self.nid is not None
 
         # The user can specify their own node ID, but it is checked
         # for correctness.
-        (self.nid,) = np.nonzero(self.pos % 2 == 0)[0]
         if nid is not None:
             assert nid in range(6) and nid % 3 == self.nid
             self.nid = nid
 
     def offset_by(self, x, y, z, nid=None):
         'Return a new node at a position offset from this one.'
-        return Node(*(self.pos + [x, y, z]), nid)
+        X, Y, Z = self.pos
+        return Node(X + x, Y + y, Z + z, nid)
+
+    @property
+    def pos_arr(self):
+        'The position of this node as an array.'
+        return np.array(self.pos)
 
     def __eq__(self, other):
-        return np.all(self.pos == other.pos)
+        return self.pos == other.pos
 
 
 class Servo:
+    __slots__ = ('node', 'other_node', 'ideality', 'pom', '_c_rot', '_rows')
+
     X, Y, Z = 0, 1, 2
 
     def __init__(self, node, direction, ideality=1.0):
         assert direction in range(3)
 
         self.node = node
-        offset = 2*(np.arange(3) == direction)
-        self.other_node = node.offset_by(*offset)
+        self.other_node = node.offset_by(*_OFFSET[direction])
         self.ideality = ideality
 
         # Unfortunately we can only identify the correct plane of
         # motion by elimination: it can't be the plane where the
         # actuator moves or the plane where it's on a voxel boundary.
         # This is always unique because it's physically impossible to
-        # rotate the actuator to make those two planes the same (this
-        # will raise a ValueError here).
-        planes = np.ones(3, bool)
-        planes[direction] = False
-        planes[self.node.nid % 3] = False
-        (self.pom,) = np.nonzero(planes)[0]
+        # rotate the actuator to make those two planes the same.
+        if direction == self.node.nid % 3:
+            raise ValueError('Servo cannot move along its own boundary.')
+        self.pom = 3 - direction - self.node.nid % 3
 
         # Correction to the sign for when this servo rotates the plane
         # of motion "backwards".
-        self._c_rot = A[self.pom, direction, self.node.nid % 3]
+        self._c_rot = _C_ROT[direction][self.node.nid % 3]
+
+        # The rows of A along which this servo moves each kind of node,
+        # with the rotation correction already applied. They're float
+        # so that actuation never does arithmetic in A's int8.
+        self._rows = self._c_rot * A_ROWS[self.pom].astype(float)
 
     def conflicts_with(self, other):
         'Return whether this servo shares a plane of motion with another.'
@@ -66,47 +121,218 @@ class Servo:
     def actuate(self, node, amount):
         '''
         Return how much this servo affects the specified node when
-        actuated by a given amount.
+        actuated by a given amount. Nodes outside the plane of motion
+        are unaffected, for which a shared read-only zero vector is
+        returned rather than a fresh one.
         '''
+        sign = self._sign(node)
+        if sign == 0:
+            return _ZERO3
+        amount = float(amount)
         if node not in (self.node, self.other_node):
             amount *= self.ideality
-
-        rotation_amount = amount * self.connectivity(node)
-        return rotation_amount * A[self.pom, :, node.nid]
+        return (sign * amount) * self._rows[node.nid]
 
     def connectivity(self, node):
         '''
         Find the sign of the connectivity matrix entry from this Servo
         to a given node.
         '''
-        if node.pos[self.pom] == self.node.pos[self.pom]:
-            c_id = -1 if node.nid > 2 else 1
-            c = (-1)**abs((node.pos - self.node.pos).sum() // 2)
-            return c * c_id * self._c_rot
-        else:
+        return self._sign(node) * self._c_rot
+
+    def _sign(self, node):
+        '''
+        Return the sign of the effect of this servo on a node before
+        the correction for its rotation, or 0 if the node isn't in its
+        plane of motion.
+        '''
+        if node.pos[self.pom] != self.node.pos[self.pom]:
             return 0
+        d = sum(node.pos) - sum(self.node.pos)
+        return 1 - 2*((d >> 1 & 1) ^ _NID_PAR_BITS[node.nid])
+
+
+def _coupling_kernel(S_pos, S_other, S_pom, S_crot, S_ideality, E_pos,
+                     E_nid, A_rows, K):
+    '''
+    Fill in the coupling tensor K of shape (E,3,S) such that K @ amounts
+    is the displacement of every end effector, using the same rules as
+    `Servo.actuate` but on the parallel arrays kept by `Voxels`. Each
+    effector's slice of K is independent, so they are filled in
+    parallel.
+    '''
+    for e in prange(E_pos.shape[0]):
+        nid_par = _NID_PAR[E_nid[e]]
+        for s in range(S_pos.shape[0]):
+            pom = S_pom[s]
+            if E_pos[e,pom] != S_pos[s,pom]:
+                continue
+            d = (E_pos[e,0] - S_pos[s,0] + E_pos[e,1] - S_pos[s,1]
+                 + E_pos[e,2] - S_pos[s,2])
+            k = (1 - 2*((d >> 1 & 1) ^ nid_par)) * S_crot[s]
+
+            node = other_node = True
+            for i in range(3):
+                node &= E_pos[e,i] == S_pos[s,i]
+                other_node &= E_pos[e,i] == S_other[s,i]
+            if not (node or other_node):
+                k *= S_ideality[s]
+
+            for i in range(3):
+                K[e,i,s] = k * A_rows[pom, E_nid[e], i]
+
+
+if njit is not None:
+    # With an explicit signature the kernel is compiled (or loaded from
+    # the on-disk cache) at import rather than on the first actuation.
+    _coupling_kernel = njit(
+        'void(int64[:,:], int64[:,:], int64[:], float64[:], float64[:],'
+        ' int64[:,:], int64[:], int8[:,:,:], float64[:,:,:])',
+        cache=True, fastmath=True, parallel=True)(_coupling_kernel)
+
+# Whether Voxels builds K with the Numba kernel or with NumPy. This can
+# be switched off to use (or test) the NumPy path even with Numba.
+_USE_NUMBA = njit is not None
 
 
 class Voxels:
-    def __init__(self, ideality=1.0):
+    def __init__(self, ideality=1.0, backend='numpy'):
+        if backend not in ('numpy', 'jax'):
+            raise ValueError(f'Unknown backend {backend!r}.')
+        if backend == 'jax':
+            # JAX is slow to import, so only do it when it's used.
+            try:
+                import jax  # noqa F401
+            except ImportError:
+                raise ImportError('The jax backend requires JAX.') from None
+        self.backend = backend
+
         self.servos = []
         self.effectors = []
         self.ideality = ideality
 
+        # Two servos conflict exactly when they share a plane of
+        # motion, so track the (pom, position along pom) pairs in use.
+        self._servo_keys = set()
+
+        # Servo and effector data are also packed into parallel arrays
+        # (structure of arrays) so all pairs can be handled at once.
+        # Like the coupling tensor from servo amounts to effector
+        # positions, they're built on first use and discarded whenever
+        # the system changes, along with the last few simulation results.
+        self._S_pos = None
+        self._K = None
+        self._K_ideality = None
+        self._actuate_jit = None
+        self._simulate_cache = OrderedDict()
+
+    def _invalidate(self):
+        'Discard everything cached for the previous set of nodes.'
+        self._S_pos = None
+        self._K = None
+        self._K_ideality = None
+        self._actuate_jit = None
+        self._simulate_cache.clear()
+
+    def _pack(self):
+        '''
+        Build the parallel arrays of servo and effector data from the
+        lists of servos and effectors, if they aren't already up to date.
+        '''
+        if self._S_pos is not None:
+            return
+
+        servos, effectors = self.servos, self.effectors
+        self._S_pos = np.array([s.node.pos for s in servos],
+                               np.int64).reshape(-1, 3)
+        self._S_other = np.array([s.other_node.pos for s in servos],
+                                 np.int64).reshape(-1, 3)
+        self._S_pom = np.array([s.pom for s in servos], np.int64)
+        self._S_pos_pom = self._S_pos[np.arange(len(servos)), self._S_pom]
+        self._S_crot = np.array([s._c_rot for s in servos], float)
+        self._E_pos = np.array([e.pos for e in effectors],
+                               np.int64).reshape(-1, 3)
+        self._E_nid = np.array([e.nid for e in effectors], np.int64)
+
+    def _freeze(self):
+        '''
+        Build the coupling tensor K of shape (N,3,M) for the current
+        servos and effectors, if it isn't already up to date. Nothing
+        but the actuation amounts varies after this, so actuating is
+        just a matrix product with K. The servos' idealities can be
+        changed at any time, so they're checked on every call.
+        '''
+        ideality = [s.ideality for s in self.servos]
+        if self._K is not None and ideality == self._K_ideality:
+            return
+
+        self._pack()
+        self._K_ideality = ideality
+        self._S_ideality = np.array(ideality, float)
+        S_pom = self._S_pom
+        if _USE_NUMBA:
+            K = np.zeros((len(self.effectors), 3, len(self.servos)))
+            _coupling_kernel(self._S_pos, self._S_other, S_pom,
+                             self._S_crot, self._S_ideality, self._E_pos,
+                             self._E_nid, A_ROWS, K)
+        else:
+            direct = (
+                (self._E_pos[None,:,:] == self._S_pos[:,None,:]).all(-1)
+                | (self._E_pos[None,:,:] == self._S_other[:,None,:]).all(-1))
+            loss = np.where(direct, 1.0, self._S_ideality[:,None])
+
+            C = self.connectivity_matrix() * loss
+            Arows = A_ROWS[S_pom[:,None], self._E_nid[None,:]]
+            K = np.ascontiguousarray(
+                (C[:,:,None] * Arows).transpose(1, 2, 0))
+        self._K = K
+        self._actuate_jit = None
+
+    def _jax_actuate(self):
+        '''
+        Return batched actuation compiled by JAX into a single XLA
+        kernel with K as a constant, which can also run on a GPU. It's
+        built on first use after K changes.
+        '''
+        if self._actuate_jit is None:
+            import jax
+            import jax.numpy as jnp
+            K_j = jnp.asarray(self._K)
+            self._actuate_jit = jax.jit(
+                lambda amounts: jnp.einsum('eks,bs->bek', K_j, amounts))
+        return self._actuate_jit
+
+    def __getstate__(self):
+        # Compiled JAX functions can't be pickled, but are rebuilt
+        # whenever they're next needed anyway.
+        state = self.__dict__.copy()
+        state['_actuate_jit'] = None
+        return state
+
     def add_servo(self, node, direction):
         new = Servo(node, direction, ideality=self.ideality)
-        for servo in self.servos:
-            if servo.conflicts_with(new):
-                raise ValueError('Servo makes system overdetermined.')
+        key = (new.pom, new.node.pos[new.pom])
+        if key in self._servo_keys:
+            raise ValueError('Servo makes system overdetermined.')
+        self._servo_keys.add(key)
         self.servos.append(new)
+        self._invalidate()
 
     def add_effector(self, node):
         self.effectors.append(node)
+        self._invalidate()
 
     def connectivity_matrix(self):
-        return np.array([
-            [s.connectivity(e) for e in self.effectors]
-            for s in self.servos])
+        '''
+        Return the (M,N) matrix of `Servo.connectivity` from each servo
+        to each end effector, computed for all pairs at once.
+        '''
+        self._pack()
+        match = self._S_pos_pom[:,None] == self._E_pos[:, self._S_pom].T
+
+        diff = (self._E_pos[None,:,:] - self._S_pos[:,None,:]).sum(-1)
+        sign = 1 - 2*((diff >> 1 & 1) ^ _NID_PAR[self._E_nid][None,:])
+        return match * sign * self._S_crot[:,None]
 
     def actuate(self, *amounts):
         '''
@@ -116,27 +342,63 @@ class Voxels:
         '''
         assert len(amounts) == len(self.servos)
 
-        disp = []
-        for e,effector in enumerate(self.effectors):
-            disp_e = np.zeros(3)
-            for amount,servo in zip(amounts, self.servos):
-                disp_e += servo.actuate(effector, amount)
-            disp.append(disp_e)
-        return np.array(disp)
+        self._freeze()
+        return self._K @ np.asarray(amounts, float)
+
+    def actuate_batch(self, amounts):
+        '''
+        Given an array of shape (B,M) with B different sets of amounts
+        for the M servos, return the positions of the N end effectors
+        for each of them in an array of shape (B,N,3). With the jax
+        backend, this is computed in JAX's default floating point
+        precision on its default device.
+        '''
+        amounts = np.asarray(amounts, float)
+        assert amounts.ndim == 2 and amounts.shape[1] == len(self.servos)
+
+        self._freeze()
+        if self.backend == 'jax':
+            return np.asarray(
+                self._jax_actuate()(amounts).block_until_ready())
+
+        N, _, M = self._K.shape
+        B = amounts.shape[0]
+        return (amounts @ self._K.reshape(3*N, M).T).reshape(B, N, 3)
 
     def simulate(self, gait):
         '''
         Given an array of shape (M,T) with the positions of M servos
         at T different timesteps, return an array of N end effector
-        positions at each of those times with shape (N,3,T).
+        positions at each of those times with shape (N,3,T). Gaits
+        are often simulated repeatedly, so recent results are cached.
         '''
-        return np.array([self.actuate(*amounts).T
-                         for amounts in np.transpose(gait)]).T
+        gait = np.asarray(gait, float)
+        assert gait.shape[0] == len(self.servos)
+
+        # Keep the 8 most recently used results, keyed on the gait and
+        # on the servo idealities, which can change without invalidation.
+        key = (gait.tobytes(), gait.shape,
+               tuple(s.ideality for s in self.servos))
+        res = self._simulate_cache.get(key)
+        if res is None:
+            res = self._simulate_cache[key] = self._simulate(gait)
+            if len(self._simulate_cache) > 8:
+                self._simulate_cache.popitem(last=False)
+        else:
+            self._simulate_cache.move_to_end(key)
+        return res.copy()
+
+    def _simulate(self, gait):
+        # Flattening K lets the whole gait go through one GEMM rather
+        # than a stack of N small matrix products.
+        self._freeze()
+        N, _, M = self._K.shape
+        return (self._K.reshape(3*N, M) @ gait).reshape(N, 3, gait.shape[1])
 
 
 class VoxelBot(Voxels):
-    def __init__(self, ideality=0.8):
-        super().__init__(ideality)
+    def __init__(self, ideality=0.8, backend='numpy'):
+        super().__init__(ideality, backend)
 
         self.add_servo(Node(2, 1, 1), Servo.Z)
         self.add_servo(Node(1, 2, 1), Servo.Z)
@@ -213,3 +475,144 @@ class TestVoxelBotGait:
                             [5, -5, 0],
                             [-5, 5, 0]]) * v.ideality
         assert np.all(v.actuate(5, -5, -5, 5) == desired)
+
+    def test_simulate(self):
+        v = VoxelBot()
+        gait = np.array([[5, 5, 0, -5, -5, -5, 0, 5],
+                         [-5, -5, 0, 5, 5, 5, 0, -5],
+                         [0, 5, 5, 5, 0, -5, -5, -5],
+                         [0, -5, -5, -5, 0, 5, 5, 5]])
+        res = v.simulate(gait)
+        assert res.shape == (4, 3, 8)
+        for t,amounts in enumerate(gait.T):
+            assert np.all(res[:,:,t] == v.actuate(*amounts))
+
+    def test_actuate_batch(self):
+        v = VoxelBot()
+        amounts = np.array([[5, -5, 0, 0],
+                            [5, -5, 5, -5],
+                            [0, 0, 5, -5]])
+        res = v.actuate_batch(amounts)
+        assert res.shape == (3, 4, 3)
+        for b,amounts_b in enumerate(amounts):
+            assert np.all(res[b] == v.actuate(*amounts_b))
+
+    def test_overdetermined(self):
+        v = VoxelBot()
+        try:
+            v.add_servo(Node(2, 1, 3), Servo.Z)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Conflicting servo was accepted.'
+        assert len(v.servos) == 4
+        assert v.servos[0].conflicts_with(Servo(Node(2, 1, 3), Servo.Z))
+
+    def test_servo_ideality(self):
+        v = VoxelBot()
+        v.actuate(5, -5, 0, 0)
+        v.servos[1].ideality = 0.1
+        assert np.allclose(v.actuate(5, -5, 0, 0)[0], [0, 0.5, 0])
+
+    def test_simulate_cache(self):
+        v = VoxelBot()
+        gait = np.array([[5, 0], [-5, 0], [0, 5], [0, -5]])
+        assert v.simulate(gait)[0,1,0] == 4
+
+        # None of these changes may return a stale cached result.
+        v.servos[1].ideality = 0.1
+        assert v.simulate(gait)[0,1,0] == 0.5
+
+        v.add_effector(Node(5, 3, 2))
+        assert v.simulate(gait).shape == (5, 3, 2)
+
+        v.add_servo(Node(5, 2, 1), Servo.Z)
+        gait = np.vstack([gait, [5, 5]])
+        res = v.simulate(gait)
+        assert np.any(res[4] != 0)
+        for t,amounts in enumerate(gait.T):
+            assert np.all(res[:,:,t] == v.actuate(*amounts))
+
+    def test_servo_integer_amounts(self):
+        s = Servo(Node(2, 1, 1), Servo.Z)
+        res = s.actuate(Node(2, 1, 1), 200)
+        assert res.dtype == float and np.all(res == [0, 0, 200])
+        assert np.all(s.actuate(s.other_node, -128) == [0, 0, 128])
+        assert np.all(s.actuate(Node(1, 1, 4, 5), 5) == [5, 0, 0])
+
+    def test_fractional_node(self):
+        for pos in [(2.5, 1, 1), (1.9, 1, 2)]:
+            try:
+                Node(*pos)
+            except AssertionError:
+                pass
+            else:
+                assert False, f'Node accepted fractional position {pos}.'
+        assert Node(2.0, 1, np.int64(1)).pos == (2, 1, 1)
+
+    def test_jax_backend(self):
+        import pytest
+        pytest.importorskip('jax')
+        amounts = np.array([[5, -5, 0, 0],
+                            [5, -5, 5, -5],
+                            [0.3, 1.7, -2.2, 4.1]])
+        res = VoxelBot(backend='jax').actuate_batch(amounts)
+        assert np.allclose(res, VoxelBot().actuate_batch(amounts),
+                           rtol=1e-6, atol=1e-5)
+
+    def test_numpy_fallback(self):
+        import sys
+        pom = sys.modules[__name__]
+        v = VoxelBot(ideality=0.7)
+        v.servos[2].ideality = 0.4
+        for x in range(5):
+            for y in range(5):
+                for z in range(5):
+                    if (x & 1) + (y & 1) + (z & 1) == 2:
+                        nid = _PARITY_TO_NID[(x&1) << 2 | (y&1) << 1 | (z&1)]
+                        v.add_effector(Node(x, y, z, nid + 3*(x > 2)))
+
+        # Build K with whichever path is active, then force NumPy.
+        v._freeze()
+        K = v._K.copy()
+        saved, pom._USE_NUMBA = pom._USE_NUMBA, False
+        try:
+            v._invalidate()
+            v._freeze()
+        finally:
+            pom._USE_NUMBA = saved
+        assert np.allclose(v._K, K)
+
+        amounts = [1.5, -2, 0.5, 3]
+        expected = [sum(s.actuate(e, a) for s,a in zip(v.servos, amounts))
+                    for e in v.effectors]
+        assert np.allclose(v._K @ amounts, expected)
+
+    def test_copy_and_pickle(self):
+        import copy
+        import pickle
+        v = VoxelBot()
+        gait = np.array([[5, 0], [-5, 0], [0, 5], [0, -5]])
+        v.simulate(gait)
+
+        w = copy.deepcopy(v)
+        w.add_effector(Node(5, 3, 2))
+        assert w.simulate(gait).shape == (5, 3, 2)
+        assert v.simulate(gait).shape == (4, 3, 2)
+        w = copy.deepcopy(v)
+        w.servos[1].ideality = 0.1
+        assert w.simulate(gait)[0,1,0] == 0.5
+        assert v.simulate(gait)[0,1,0] == 4
+
+        w = pickle.loads(pickle.dumps(v))
+        assert np.all(w.simulate(gait) == v.simulate(gait))
+
+    def test_jax_pickle(self):
+        import pickle
+        import pytest
+        pytest.importorskip('jax')
+        v = VoxelBot(backend='jax')
+        amounts = np.array([[5, -5, 0, 0]])
+        res = v.actuate_batch(amounts)
+        w = pickle.loads(pickle.dumps(v))
+        assert np.all(w.actuate_batch(amounts) == res)
@@ -18,4 +18,5 @@ setup(
         'Development Status :: 2 - Beta',
         'Programming Language :: Python :: 3'],
     packages=find_packages(exclude=()),
-    install_requires=['numpy'])
+    install_requires=['numpy'],
+    extras_require={'jit': ['numba'], 'jax': ['jax']})